@@ -3,44 +3,31 @@
 # Author Huw Jenkins 18.03.22
 # Last update 18.03.22
 
-from _ctypes import PyObj_FromPtr
+import fnmatch
 import glob
 import json
+import mmap
 import os
-import sys
 import re
-
-# modified from https://stackoverflow.com/questions/13249415/how-to-implement-custom-indentation-when-pretty-printing-with-the-json-module
-class NoIndent(object):
-    """ Value wrapper. """
-    def __init__(self, value):
-        self.value = value
-
-class CustomEncoder(json.JSONEncoder):
-    FORMAT_SPEC = '@@{}@@'
-    regex = re.compile(FORMAT_SPEC.format(r'(\d+)'))
-
-    def __init__(self, **kwargs):
-      super(CustomEncoder, self).__init__(**kwargs)
-
-    def default(self, obj):
-      return (self.FORMAT_SPEC.format(id(obj)) if isinstance(obj, NoIndent) else super(CustomEncoder, self).default(obj))
-
-    def encode(self, obj):
-      format_spec = self.FORMAT_SPEC  # Local var to expedite access.
-      json_repr = super(CustomEncoder, self).encode(obj)  # Default JSON.
-      for match in self.regex.finditer(json_repr):
-        # see https://stackoverflow.com/a/15012814/355230
-        id = int(match.group(1))
-        no_indent = PyObj_FromPtr(id)
-        json_obj_repr = json.dumps(no_indent.value)
-        json_repr = json_repr.replace('"{}"'.format(format_spec.format(id)), json_obj_repr)
-      return json_repr
+import sys
+from operator import itemgetter
+# use orjson if available for speed
+try:
+  import orjson
+  def json_dumps(obj):
+    return orjson.dumps(obj).decode()
+  json_loads = orjson.loads
+except ImportError:
+  def json_dumps(obj):
+    return json.dumps(obj, separators=(',', ':'))
+  def json_loads(buf):
+    return json.loads(bytes(buf))
 
 # default processing options
 parameters = {
               "nproc":4,
               "njobs":2,
+              "ncores":None,
               "sample":"SAMPLE",
               "spacegroup":None,
               "import":"goniometer.axes=1,0,0 distance=958.5 panel.pedestal=-64",
@@ -49,58 +36,98 @@ parameters = {
               "find_spots":"d_min=1",
               "index":"detector.fix=distance",
               "refine":"detector.fix=distance",
-              "integrate":""
+              "integrate":"",
+              "stage_cache":False,
+              "in_process":False
 }
 datasets = []
 
+def read_json(filename):
+  # parse straight from a memory map of the file, orjson reads the mapped bytes without a copy
+  with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as buf:
+    return json_loads(buf)
+
 def make_template(template):
   number, extension = os.path.basename(template).split('.')[-2].split('_')[-1],  template.split('.')[-1]
   return template.replace('.'.join([number,extension]),'.'.join(['####',extension]))
 
 def get_xtal(template):
-  xtal = [ x for x in os.path.basename(template).split('_') if 'xtal' in x]
-  try:
-    return int(xtal[0][4:]) if xtal else None
-  except ValueError:
-    return None
+  xtal = next((x for x in os.path.basename(template).split('_') if x.startswith('xtal')), None)
+  return int(xtal[4:]) if xtal and xtal[4:].isdigit() else None
 
 def get_grid(template):
-    grid_idx = [i for i, j in enumerate(template.split(os.path.sep)) if 'grid' in j]
-    if len(grid_idx) > 0:
-      grid = [g for g in template.split(os.path.sep)[grid_idx[-1]].split('_') if 'grid' in g]
-      try:
-        return int(grid[0][4:])
-      except ValueError:
-        return None
-    else:
-      return None
+  # use the last part of the path containing a gridN token
+  for part in reversed(template.split(os.path.sep)):
+    grid = next((g for g in part.split('_') if g.startswith('grid')), None)
+    if grid is not None:
+      return int(grid[4:]) if grid[4:].isdigit() else None
+  return None
+
+def find_files(template):
+  # equivalent to glob.glob(os.path.join('**', template), recursive=True) but
+  # matching is done on file names only so each directory is listed just once
+  if os.path.dirname(template):
+    return glob.glob(os.path.join('**', template), recursive=True)
+  match = re.compile(fnmatch.translate(template)).match
+  match_hidden = template.startswith('.')
+  def walk(path):
+    try:
+      with os.scandir(path or os.curdir) as it:
+        entries = list(it)
+    except OSError:
+      return
+    for entry in entries:
+      if entry.name.startswith('.'):
+        if not match_hidden or entry.is_dir():
+          continue
+      if entry.is_dir():
+        yield from walk(os.path.join(path, entry.name))
+      elif match(entry.name):
+        yield os.path.join(path, entry.name)
+  return list(walk(''))
 
 def generate_datasets(template):
   datasets = []
-  templates = glob.glob(os.path.join('**', template),recursive=True)
+  templates = find_files(template)
   for template in templates:
-    datasets.append({'template':make_template(template), 
-                     'grid':get_grid(template) if get_grid(template) else 1,
-                     'xtal':get_xtal(template) if get_xtal(template) else 1})
-  return sorted(datasets, key = lambda x: (x['grid'], x['xtal']))
+    grid = get_grid(template)
+    xtal = get_xtal(template)
+    datasets.append({'template':make_template(template),
+                     'grid':grid or 1,
+                     'xtal':xtal or 1})
+  return sorted(datasets, key=itemgetter('grid', 'xtal'))
+
+def dump_datasets_json(d, f):
+  # parameters are pretty printed, each dataset is written on a single line
+  f.write('{\n  "parameters":')
+  f.write(json.dumps(d['parameters'], indent=2, separators=(',', ':')).replace('\n', '\n  '))
+  f.write(',\n  "datasets":[')
+  sep = '\n    '
+  for ds in d['datasets']:
+    f.write(sep)
+    f.write(json_dumps(ds))
+    sep = ',\n    '
+  f.write('\n  ]\n}\n')
 
 def write_datasets_json(template):
   if not os.path.exists('datasets.json'):
     datasets = generate_datasets(template)
-    d = {'parameters':parameters, 'datasets':[NoIndent(ds) for ds in datasets]}
+    d = {'parameters':parameters, 'datasets':datasets}
     print(f'Searching for files matching {template} and writing {len(datasets)} dataset(s) to datasets.json')
   else:
     try:
-      with open('datasets.json') as f:
-        d = json.load(f)
-    except json.decoder.JSONDecodeError as e:
+      d = read_json('datasets.json')
+    except ValueError as e:
       sys.exit(f'datasets.json exists but cannot be read. Error {e}')
-    new_datasets = sorted([ds for ds in generate_datasets(template) if ds not in d['datasets']], key = lambda x: (x['grid'], x['xtal']))
+    seen = {(ds.get('template'), ds.get('grid'), ds.get('xtal')) for ds in d['datasets']}
+    new_datasets = sorted([ds for ds in generate_datasets(template) if (ds['template'], ds['grid'], ds['xtal']) not in seen], key=itemgetter('grid', 'xtal'))
     d['datasets'].extend(new_datasets)
-    d.update({'datasets':[NoIndent(ds) for ds in d['datasets']]})
     print(f'Searching for files matching {template} and adding {len(new_datasets)} dataset(s) to existing datasets.json')
-  with open('datasets.json', 'w') as f:
-    print(json.dumps(d, cls=CustomEncoder, indent=2, separators=(',', ':')), file=f)
+    if not new_datasets:
+      # existing datasets are already on disk in the same format
+      return
+  with open('datasets.json', 'w', encoding='utf-8') as f:
+    dump_datasets_json(d, f)
 
 if __name__ == '__main__':
   if len(sys.argv) != 2:
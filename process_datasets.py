@@ -3,190 +3,433 @@
 # Author Huw Jenkins 10.05.21
 # Last update 28.07.22
 
-import math
+import contextlib
+import functools
+import glob
+import hashlib
+import importlib
+import io
 import os
 import sys
 import time
+import traceback
 import logging
+import logging.handlers
 import json
-from libtbx import easy_run, easy_mp, Auto
+import mmap
+import multiprocessing
+import shlex
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+# use orjson if available for speed
+try:
+  from orjson import loads as json_loads
+except ImportError:
+  def json_loads(buf):
+    return json.loads(bytes(buf))
+import numpy as np
+from libtbx import Auto
 from dials.array_family import flex
 from dxtbx.serialize import load
 from dxtbx.util import format_float_with_standard_uncertainty
 
 __version__ = '0.3.5'
+# bump if the contents of result.json change
+RESULT_VERSION = 3
+
+def read_json(filename):
+  # parse straight from a memory map of the file, orjson reads the mapped bytes without a copy
+  with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as buf:
+    return json_loads(buf)
+
+def available_cores():
+  # cores this process may run on, which under a batch system can be far fewer than the machine has
+  if hasattr(os, 'sched_getaffinity'):
+    return len(os.sched_getaffinity(0))
+  return os.cpu_count() or 1
+
+class CoreBudget:
+  # cores shared by all the worker processes so that njobs x nproc does not oversubscribe the machine
+  def __init__(self, ncores, mp_context):
+    self.total = ncores
+    self.free = mp_context.Value('i', ncores, lock=False)
+    self.condition = mp_context.Condition()
+  def acquire(self, ncores):
+    # wait until all the requested cores (or every core if fewer) are free so a
+    # long multi-threaded step is not left running on whatever happened to be spare
+    ncores = min(ncores, self.total)
+    with self.condition:
+      self.condition.wait_for(lambda: self.free.value >= ncores)
+      self.free.value -= ncores
+      return ncores
+  def release(self, ncores):
+    with self.condition:
+      self.free.value += ncores
+      self.condition.notify_all()
+
+# DIALS programs whose dials.command_line module name differs from the program name
+IN_PROCESS_MODULES = {'dials.import':'dials_import'}
+# loggers that DIALS programs add their own console and logfile handlers to
+DIALS_LOGGERS = ('dials', 'dxtbx', 'py.warnings')
+
+# set in each worker by init_worker
+core_budget = None
+
+def init_worker(log_queue, budget):
+  global core_budget
+  core_budget = budget
+  # log records are passed to a listener in the main process which does all the writing
+  log = logging.getLogger()
+  for handler in log.handlers[:]:
+    log.removeHandler(handler)
+  log.addHandler(logging.handlers.QueueHandler(log_queue))
+  log.setLevel(logging.INFO)
+  # import heavy modules once when each worker starts rather than in its first task
+  import dials.array_family.flex
+  import dxtbx.serialize.load
 
 class ProcessDataset:
   def __init__(self, parameters):
       self.parameters = parameters
+      # workers are reused so paths must not depend on the current directory
+      self.base_dir = os.getcwd()
       self.log = logging.getLogger(__name__)
-  def __call__(self, dataset):
-    work_dir = os.path.join(os.getcwd(), self.parameters['sample'], f'grid{dataset["grid"]}', f'xtal{dataset["xtal"]:03}')
+      # the parts of the command lines that are the same for every dataset
+      self.import_options = parameters['import']
+      self.generate_mask_options = parameters.get('generate_mask')
+      self.find_spots_options = parameters['find_spots']
+      self.refine_static_options = f'{parameters["refine"]} scan_varying=false'
+      self.refine_options = f'{parameters["refine"]} scan_varying=true'
+      self.integrate_options = parameters['integrate']
+      self.find_rotation_axis_options = parameters.get('find_rotation_axis')
+      # outputs of DIALS programs are only reused from .stage_cache if asked for
+      self.stage_cache = bool(parameters.get('stage_cache'))
+      self.index_in_P1 = parameters['spacegroup'] in [None, 'P1']
+      self.initial_index_P1 = not self.index_in_P1 and bool(parameters.get('initial_index_P1'))
+      self.index_options = parameters['index'] if self.index_in_P1 else f'{parameters["index"]} space_group={parameters["spacegroup"]}'
+      # optional stages are only included if they are switched on
+      self.stages = [self.stage_import]
+      if parameters.get('generate_mask'):
+        self.stages.append(self.stage_mask)
+      self.stages.append(self.stage_find_spots)
+      if parameters.get('search_beam'):
+        self.stages.append(self.stage_search_beam)
+      if parameters.get('find_rotation_axis'):
+        self.stages.append(self.stage_find_rotation_axis)
+      self.stages += [self.stage_index, self.stage_refine, self.stage_integrate]
+  def __call__(self, datasets):
+    # a chunk of datasets is processed in turn within a single worker task
+    return [self.process(dataset) for dataset in datasets]
+  def process(self, dataset):
+    work_dir = os.path.join(self.base_dir, self.parameters['sample'], f'grid{dataset["grid"]}', f'xtal{dataset["xtal"]:03}')
     dataset_id = '/'.join(work_dir.split(os.path.sep)[-3:])
     try:
       os.makedirs(work_dir)
     except FileExistsError:
       pass
-    os.chdir(work_dir)
 
     # already run?
-    if os.path.isfile('integrated.expt'):
+    if os.path.isfile(os.path.join(work_dir, 'integrated.expt')):
       self.log.info(f'Skipping {dataset_id} as file integrated.expt exists')
-      return self.get_result(dataset_id=dataset_id, experiments='integrated.expt', reflections='indexed.refl', skipped=True)
+      return {'dataset_id':dataset_id, 'work_dir':work_dir, 'skipped':True}
 
-    # import
+    # each stage returns the experiments file to carry forward or None if processing failed
+    expt = None
+    for stage in self.stages:
+      expt = stage(dataset, work_dir, dataset_id, expt)
+      if expt is None:
+        return
+
+    # success, the results are read by summarise in the main process
+    return {'dataset_id':dataset_id, 'work_dir':work_dir, 'skipped':False}
+
+  def stage_import(self, dataset, work_dir, dataset_id, expt):
+    path = functools.partial(self.path, work_dir)
     if dataset.get('template'):
-      cmd = f'dials.import template=../../../{dataset["template"]} {self.parameters["import"]}'
+      cmd = f'dials.import template={self.path(self.base_dir, dataset["template"])} {self.import_options}'
     else:
-      cmd = f'dials.import ../../../{dataset["file"]} {self.parameters["import"]}'
+      cmd = f'dials.import {self.path(self.base_dir, dataset["file"])} {self.import_options}'
     if dataset.get('image_range'):
       cmd += f' image_range={dataset["image_range"]}'
-    r = easy_run.fully_buffered(command=cmd)
-    if len(r.stderr_lines) > 0:
-      with open('dials.import.err', 'w') as f:
-        f.write('\n'.join(r.stderr_lines))
-        if dataset.get('template'):
-          self.log.info(f'import of {dataset["template"]} failed!')
-        else:
-          self.log.info(f'import of {dataset["file"]} failed!')
+    cmd += f' output.experiments={path("imported.expt")} output.log={path("dials.import.log")}'
+    if not self.cached_run(cmd, work_dir, 'dials.import.err', inputs=self.image_files(dataset), outputs=['imported.expt']):
+      if dataset.get('template'):
+        self.log.info(f'import of {dataset["template"]} failed!')
+      else:
+        self.log.info(f'import of {dataset["file"]} failed!')
       return
+    return 'imported.expt'
 
-    if self.parameters.get('generate_mask') and self.parameters['generate_mask'] != '':
-      # generate mask
-      cmd = f'dials.generate_mask imported.expt {self.parameters["generate_mask"]}'
-      r = easy_run.fully_buffered(command=cmd)
-      if len(r.stderr_lines) > 0:
-        with open('dials.generate_mask.err', 'w') as f:
-          f.write('\n'.join(r.stderr_lines))
-
-      # apply mask
-      cmd = f'dials.apply_mask imported.expt mask=pixels.mask'
-      r = easy_run.fully_buffered(command=cmd)
-      if len(r.stderr_lines) > 0:
-        with open('dials.apply_mask.err', 'w') as f:
-          f.write('\n'.join(r.stderr_lines))
-      else:
-        expt = 'masked.expt'
-    else:
-      expt = 'imported.expt'
-
-    # find spots
-    cmd = f'dials.find_spots {expt} {self.parameters["find_spots"]} nproc={self.parameters["nproc"]}'
-    r = easy_run.fully_buffered(command=cmd)
-    if len(r.stderr_lines) > 0:
-      with open('dials.find_spots.err', 'w') as f:
-        f.write('\n'.join(r.stderr_lines))
-
-    # search beam position
-    if self.parameters.get('search_beam'):
-      cmd = f'dials.search_beam_position {expt} strong.refl output.experiments=optimised_beam.expt'
-      r = easy_run.fully_buffered(command=cmd)
-      if len(r.stderr_lines) > 0:
-        with open('dials.search_beam_position.err', 'w') as f:
-          f.write('\n'.join(r.stderr_lines))
-      else:
-        expt = 'optimised_beam.expt'
-
-    # find rotation axis
-    if self.parameters.get('find_rotation_axis'):
-      cmd = f'dials.find_rotation_axis {expt} strong.refl {self.parameters["find_rotation_axis"]} output.experiments=optimised_axis.expt'
-      r = easy_run.fully_buffered(command=cmd)
-      if len(r.stderr_lines) > 0:
-        with open('find_rotation_axis.err', 'w') as f:
-          f.write('\n'.join(r.stderr_lines))
-      else:
-        expt = 'optimised_axis.expt'
-
-    if self.parameters['spacegroup'] in [None, 'P1']:
-      # index in P1
-      cmd = f'dials.index {expt} strong.refl {self.parameters["index"]}'
-      r = easy_run.fully_buffered(command=cmd)
-      if len(r.stderr_lines) > 0:
-        with open('dials.index.err', 'w') as f:
-          f.write('\n'.join(r.stderr_lines))
-    else:
-      if self.parameters.get('initial_index_P1'):
-        cmd = f'dials.index {expt} strong.refl {self.parameters["index"]} output.experiments=P1.expt output.reflections=P1.refl output.log=dials.index_P1.log'
-        r = easy_run.fully_buffered(command=cmd)
-        if len(r.stderr_lines) > 0:
-          with open('dials.index_P1.err', 'w') as f:
-            f.write('\n'.join(r.stderr_lines))
-        else:
-          expt = 'P1.expt'
-
-      cmd = f'dials.index {expt} strong.refl {self.parameters["index"]} space_group={self.parameters["spacegroup"]}'
-      r = easy_run.fully_buffered(command=cmd)
-      if len(r.stderr_lines) > 0:
-        with open('dials.index.err', 'w') as f:
-          f.write('\n'.join(r.stderr_lines))
-    if not os.path.isfile('indexed.expt'):
+  def stage_mask(self, dataset, work_dir, dataset_id, expt):
+    path = functools.partial(self.path, work_dir)
+    # generate mask
+    cmd = f'dials.generate_mask {path("imported.expt")} {self.generate_mask_options} output.mask={path("pixels.mask")} output.log={path("dials.generate_mask.log")}'
+    self.cached_run(cmd, work_dir, 'dials.generate_mask.err', inputs=['imported.expt'], outputs=['pixels.mask'])
+    if not os.path.isfile(os.path.join(work_dir, 'pixels.mask')):
+      self.log.info(f'{dataset_id} failed in mask generation')
+      return
+
+    # apply mask
+    cmd = f'dials.apply_mask {path("imported.expt")} mask={path("pixels.mask")} output.experiments={path("masked.expt")}'
+    self.cached_run(cmd, work_dir, 'dials.apply_mask.err', inputs=['imported.expt', 'pixels.mask'], outputs=['masked.expt'])
+    if not os.path.isfile(os.path.join(work_dir, 'masked.expt')):
+      self.log.info(f'{dataset_id} failed to apply mask')
+      return
+    return 'masked.expt'
+
+  def stage_find_spots(self, dataset, work_dir, dataset_id, expt):
+    path = functools.partial(self.path, work_dir)
+    cmd = f'dials.find_spots {path(expt)} {self.find_spots_options} output.reflections={path("strong.refl")} output.log={path("dials.find_spots.log")}'
+    self.cached_run(cmd, work_dir, 'dials.find_spots.err', inputs=[expt], outputs=['strong.refl'], nproc=self.parameters['nproc'])
+    if not os.path.isfile(os.path.join(work_dir, 'strong.refl')):
+      self.log.info(f'{dataset_id} failed in spot finding')
+      return
+    return expt
+
+  def stage_search_beam(self, dataset, work_dir, dataset_id, expt):
+    path = functools.partial(self.path, work_dir)
+    cmd = f'dials.search_beam_position {path(expt)} {path("strong.refl")} output.experiments={path("optimised_beam.expt")} output.log={path("dials.search_beam_position.log")}'
+    if self.cached_run(cmd, work_dir, 'dials.search_beam_position.err', inputs=[expt, 'strong.refl'], outputs=['optimised_beam.expt']) and os.path.isfile(os.path.join(work_dir, 'optimised_beam.expt')):
+      expt = 'optimised_beam.expt'
+    return expt
+
+  def stage_find_rotation_axis(self, dataset, work_dir, dataset_id, expt):
+    path = functools.partial(self.path, work_dir)
+    cmd = f'dials.find_rotation_axis {path(expt)} {path("strong.refl")} {self.find_rotation_axis_options} output.experiments={path("optimised_axis.expt")} output.log={path("dials.find_rotation_axis.log")}'
+    if self.cached_run(cmd, work_dir, 'find_rotation_axis.err', inputs=[expt, 'strong.refl'], outputs=['optimised_axis.expt']) and os.path.isfile(os.path.join(work_dir, 'optimised_axis.expt')):
+      expt = 'optimised_axis.expt'
+    return expt
+
+  def stage_index(self, dataset, work_dir, dataset_id, expt):
+    path = functools.partial(self.path, work_dir)
+    if self.initial_index_P1:
+      cmd = f'dials.index {path(expt)} {path("strong.refl")} {self.parameters["index"]} output.experiments={path("P1.expt")} output.reflections={path("P1.refl")} output.log={path("dials.index_P1.log")}'
+      if self.cached_run(cmd, work_dir, 'dials.index_P1.err', inputs=[expt, 'strong.refl'], outputs=['P1.expt', 'P1.refl']) and os.path.isfile(os.path.join(work_dir, 'P1.expt')):
+        expt = 'P1.expt'
+
+    # index, in the target space group unless that is P1
+    cmd = f'dials.index {path(expt)} {path("strong.refl")} {self.index_options} output.experiments={path("indexed.expt")} output.reflections={path("indexed.refl")} output.log={path("dials.index.log")}'
+    self.cached_run(cmd, work_dir, 'dials.index.err', inputs=[expt, 'strong.refl'], outputs=['indexed.expt', 'indexed.refl'])
+    if not os.path.isfile(os.path.join(work_dir, 'indexed.expt')):
       self.log.info(f'{dataset_id} failed to index in space group {self.parameters["spacegroup"]}')
       return
+    return 'indexed.expt'
 
+  def stage_refine(self, dataset, work_dir, dataset_id, expt):
+    path = functools.partial(self.path, work_dir)
     # refine (static)
-    cmd = f'dials.refine indexed.expt indexed.refl {self.parameters["refine"]} scan_varying=false output.experiments=refined_static.expt output.reflections=refined_static.refl'
-    r = easy_run.fully_buffered(command=cmd)
-    if len(r.stderr_lines) > 0:
-      with open('dials.refine_static.err', 'w') as f:
-        f.write('\n'.join(r.stderr_lines))
-    if not os.path.isfile('refined_static.expt'):
+    cmd = f'dials.refine {path("indexed.expt")} {path("indexed.refl")} {self.refine_static_options} output.experiments={path("refined_static.expt")} output.reflections={path("refined_static.refl")} output.log={path("dials.refine_static.log")}'
+    self.cached_run(cmd, work_dir, 'dials.refine_static.err', inputs=['indexed.expt', 'indexed.refl'], outputs=['refined_static.expt', 'refined_static.refl'])
+    if not os.path.isfile(os.path.join(work_dir, 'refined_static.expt')):
       self.log.info(f'{dataset_id} failed in intitial refinement')
       return
 
     # refine (scan varying)
-    cmd = f'dials.refine refined_static.expt refined_static.refl {self.parameters["refine"]} scan_varying=true'
-    r = easy_run.fully_buffered(command=cmd)
-    if len(r.stderr_lines) > 0:
-      with open('dials.refine.err', 'w') as f:
-        f.write('\n'.join(r.stderr_lines))
-    if not os.path.isfile('refined.expt'):
+    cmd = f'dials.refine {path("refined_static.expt")} {path("refined_static.refl")} {self.refine_options} output.experiments={path("refined.expt")} output.reflections={path("refined.refl")} output.log={path("dials.refine.log")}'
+    self.cached_run(cmd, work_dir, 'dials.refine.err', inputs=['refined_static.expt', 'refined_static.refl'], outputs=['refined.expt', 'refined.refl'])
+    if not os.path.isfile(os.path.join(work_dir, 'refined.expt')):
       self.log.info(f'{dataset_id} failed in scan varying refinement')
       return
+    return 'refined.expt'
 
-    # integrate 
-    cmd = f'dials.integrate refined.expt refined.refl {self.parameters["integrate"]} nproc={self.parameters["nproc"]}'
-    r = easy_run.fully_buffered(command=cmd)
-    if len(r.stderr_lines) > 0:
-      with open('dials.integrate.err', 'w') as f:
-        f.write('\n'.join(r.stderr_lines))
-    if not os.path.isfile('integrated.expt'):
+  def stage_integrate(self, dataset, work_dir, dataset_id, expt):
+    path = functools.partial(self.path, work_dir)
+    cmd = f'dials.integrate {path("refined.expt")} {path("refined.refl")} {self.integrate_options} output.experiments={path("integrated.expt")} output.reflections={path("integrated.refl")} output.log={path("dials.integrate.log")}'
+    # never taken from the cache, removing integrated.expt is how a dataset is reprocessed
+    self.run_command(cmd, work_dir, 'dials.integrate.err', nproc=self.parameters['nproc'])
+    if not os.path.isfile(os.path.join(work_dir, 'integrated.expt')):
       self.log.info(f'{dataset_id} failed in integration')
       return
+    return 'integrated.expt'
+
+  def path(self, directory, name):
+    # absolute path of name quoted for use on a command line
+    return shlex.quote(os.path.join(directory, name))
+
+  def image_files(self, dataset):
+    # the images read by dials.import, the ####s in a template match the image number
+    if dataset.get('template'):
+      return sorted(glob.glob(os.path.join(glob.escape(self.base_dir), glob.escape(dataset['template']).replace('#', '[0-9]'))))
+    return [os.path.join(self.base_dir, dataset['file'])]
+
+  def cached_run(self, cmd, work_dir, err_file, inputs, outputs, nproc=None):
+    # like run_command but if stage_cache is set the outputs of a clean run are kept in .stage_cache
+    # and hard linked back in when the command line, the program and the input files are unchanged
+    if not self.stage_cache:
+      return self.run_command(cmd, work_dir, err_file, nproc=nproc)
+    program = shutil.which(shlex.split(cmd)[0])
+    if program is None or not inputs:
+      return self.run_command(cmd, work_dir, err_file, nproc=nproc)
+    key = hashlib.sha256(cmd.encode())
+    try:
+      # a different DIALS install gives a different key
+      st = os.stat(program)
+      key.update(f'{program} {st.st_size} {st.st_mtime_ns}'.encode())
+      for name in inputs:
+        st = os.stat(os.path.join(work_dir, name))
+        key.update(f'{name} {st.st_size} {st.st_mtime_ns}'.encode())
+    except FileNotFoundError:
+      # let the program report the missing input
+      return self.run_command(cmd, work_dir, err_file, nproc=nproc)
+    stage_dir = os.path.join(work_dir, '.stage_cache', err_file[:-len('.err')])
+    cache_dir = os.path.join(stage_dir, key.hexdigest())
+    if os.path.isdir(cache_dir):
+      try:
+        for name in os.listdir(cache_dir):
+          output = os.path.join(work_dir, name)
+          if os.path.lexists(output):
+            os.unlink(output)
+          os.link(os.path.join(cache_dir, name), output)
+        # as after a clean run, no .err file is left from an earlier failed attempt
+        if os.path.lexists(os.path.join(work_dir, err_file)):
+          os.unlink(os.path.join(work_dir, err_file))
+        return True
+      except OSError as e:
+        self.log.info(f'Unable to use {cache_dir} Error {e}')
+    # remove old outputs first so that the program cannot write through a link into the cache
+    for name in outputs:
+      output = os.path.join(work_dir, name)
+      if os.path.lexists(output):
+        os.unlink(output)
+    success = self.run_command(cmd, work_dir, err_file, nproc=nproc)
+    if success and all(os.path.isfile(os.path.join(work_dir, name)) for name in outputs):
+      # only the latest outputs of each stage are kept
+      shutil.rmtree(stage_dir, ignore_errors=True)
+      tmp_dir = f'{cache_dir}.tmp'
+      try:
+        os.makedirs(tmp_dir)
+        for name in outputs:
+          os.link(os.path.join(work_dir, name), os.path.join(tmp_dir, name))
+        os.rename(tmp_dir, cache_dir)
+      except OSError:
+        # e.g. a filesystem without hard links, carry on without caching
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return success
+
+  def run_command(self, cmd, work_dir, err_file, nproc=None):
+    # run a DIALS program in work_dir, writing anything on stderr to err_file. Returns True if stderr was empty
+    # multi-threaded programs wait until the requested nproc cores are free
+    ncores = core_budget.acquire(nproc or 1) if core_budget is not None else (nproc or 1)
+    if nproc:
+      cmd += f' nproc={ncores}'
+    err_path = os.path.join(work_dir, err_file)
+    try:
+      with open(err_path, 'wb') as f:
+        if self.parameters.get('in_process'):
+          f.write(self.run_in_process(cmd, work_dir))
+        else:
+          # stderr goes straight to the file without passing through this process
+          try:
+            subprocess.run(shlex.split(cmd), cwd=work_dir, stdout=subprocess.DEVNULL, stderr=f, check=False)
+          except OSError as e:
+            # e.g. a program missing from this DIALS version, fails the step like any other error
+            f.write(f'{cmd}: {e}\n'.encode())
+    finally:
+      if core_budget is not None:
+        core_budget.release(ncores)
+    if os.path.getsize(err_path) > 0:
+      return False
+    os.unlink(err_path)
+    return True
+
+  def run_in_process(self, cmd, work_dir):
+    # call the DIALS program's run() in this worker rather than starting a new dials.python. Returns stderr
+    # the inputs and outputs set here are absolute paths, changing directory catches any other files
+    # a program writes under default names (e.g. plots) and is safe as each worker handles one dataset at a time
+    program, *args = shlex.split(cmd)
+    stderr = io.StringIO()
+    # each run() sets up its own logging, which must neither reach the worker's queue
+    # nor outlive the call and write to the next program's stdout or logfile
+    loggers = [logging.getLogger(name) for name in DIALS_LOGGERS]
+    saved = [(logger.handlers[:], logger.propagate, logger.level) for logger in loggers]
+    for logger in loggers:
+      logger.propagate = False
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+      with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(stderr):
+        module = importlib.import_module(f'dials.command_line.{IN_PROCESS_MODULES.get(program, program[len("dials."):])}')
+        module.run(args=args)
+    except SystemExit as e:
+      if e.code:
+        stderr.write(f'{program} exited with status {e.code}\n')
+    except Exception:
+      stderr.write(traceback.format_exc())
+    finally:
+      os.chdir(cwd)
+      for logger, (handlers, propagate, level) in zip(loggers, saved):
+        for handler in logger.handlers[:]:
+          if handler not in handlers:
+            logger.removeHandler(handler)
+            handler.close()
+        logger.propagate = propagate
+        logger.setLevel(level)
+    return stderr.getvalue().encode()
 
-    # success
-    return self.get_result(dataset_id=dataset_id, experiments='integrated.expt', reflections='indexed.refl')
+  def summarise(self, dataset_id, work_dir, skipped):
+    # called from a thread in the main process with what process returned for a dataset
+    if skipped:
+      result = self.read_result(dataset_id, work_dir)
+      if result is not None:
+        return result
+    return self.get_result(dataset_id=dataset_id, work_dir=work_dir, experiments='integrated.expt', reflections='indexed.refl', skipped=skipped)
 
-  def get_result(self, dataset_id, experiments, reflections, skipped=False):
-    el = load.experiment_list(experiments)
+  def get_result(self, dataset_id, work_dir, experiments, reflections, skipped=False):
+    el = load.experiment_list(os.path.join(work_dir, experiments))
     xtal = el.crystals()[0]
     uc = xtal.get_unit_cell().parameters()
     uc_sd = xtal.get_cell_parameter_sd()
     sg = str(xtal.get_space_group().info())
     if not skipped:
-      unit_cell = [format_float_with_standard_uncertainty(v, e, minimum=1.0e-5) for (v, e) in zip(uc, uc_sd)]
-      self.log.info(f'{dataset_id} processed successfully {sg} {" ".join(unit_cell)}')
-    formatted_unit_cell = [f'{v:6.2f}' if e > 1.0e-5 else f'{round(v,0):3.0f}' for (v, e) in zip(uc, uc_sd)]
-    refl = flex.reflection_table.from_file(reflections)
+      unit_cell = ' '.join(format_float_with_standard_uncertainty(v, e, minimum=1.0e-5) for (v, e) in zip(uc, uc_sd))
+      self.log.info(f'{dataset_id} processed successfully {sg} {unit_cell}')
+    refl = flex.reflection_table.from_file(os.path.join(work_dir, reflections))
     n_total = len(refl)
     refined = refl.get_flags(refl.flags.used_in_refinement)
     indexed = refl.get_flags(refl.flags.indexed)
-    n_indexed = len(refl.select(indexed))
-    refl = refl.select(refined)
-    xo, yo, zo = refl["xyzobs.px.value"].parts()
-    xc, yc, zc = refl["xyzcal.px"].parts()
-    rmsd_x = math.sqrt(flex.mean(flex.pow2(xo - xc)))
-    rmsd_y = math.sqrt(flex.mean(flex.pow2(yo - yc)))
-    rmsd_z = math.sqrt(flex.mean(flex.pow2(zo - zc)))
-    formatted_rmsds = f'{rmsd_x:8.5f} {rmsd_y:8.5f} {rmsd_z:8.5f}'
-    return {'dataset_id':dataset_id,
-            'output_files':[os.path.abspath('integrated.expt'), os.path.abspath('integrated.refl')] if not skipped else [],
-            'sg':sg,
-            'uc':formatted_unit_cell,
-            'total':n_total,
-            'indexed':n_indexed,
-            'unindexed':n_total - n_indexed,
-            'rmsds':formatted_rmsds,
-           }
+    n_indexed = indexed.count(True)
+    # select just the two columns needed rather than copying the whole table, as
+    # (N, 3) arrays so all three rmsds come from a single reduction
+    delta = refl["xyzobs.px.value"].select(refined).as_numpy_array() - refl["xyzcal.px"].select(refined).as_numpy_array()
+    rmsds = np.sqrt(np.einsum('ij,ij->j', delta, delta) / len(delta))
+    result = {'dataset_id':dataset_id,
+              'output_files':[os.path.join(work_dir, 'integrated.expt'), os.path.join(work_dir, 'integrated.refl')] if not skipped else [],
+              'sg':sg,
+              'uc':list(uc),
+              'uc_sd':list(uc_sd),
+              'total':n_total,
+              'indexed':n_indexed,
+              'unindexed':n_total - n_indexed,
+              'rmsds':[float(v) for v in rmsds],
+             }
+    # cache the summary so re-runs can skip reading integrated.expt
+    with open(os.path.join(work_dir, 'result.json'), 'w') as f:
+      json.dump({'version':RESULT_VERSION, **{k:v for k, v in result.items() if k != 'output_files'}}, f)
+    return result
+
+  def read_result(self, dataset_id, work_dir):
+    # summary cached by get_result, None if missing or out of date
+    result_file = os.path.join(work_dir, 'result.json')
+    try:
+      mtime = os.stat(result_file).st_mtime_ns
+      # the files the summary was read from must not have been replaced since
+      if any(os.stat(os.path.join(work_dir, name)).st_mtime_ns > mtime for name in ('integrated.expt', 'indexed.refl')):
+        return None
+      with open(result_file, 'rb') as f:
+        result = json_loads(f.read())
+    except (OSError, ValueError):
+      return None
+    if result.pop('version', None) != RESULT_VERSION:
+      return None
+    result.update({'dataset_id':dataset_id, 'output_files':[]})
+    return result
+
+def format_summary(r):
+  # results hold raw values, they are only formatted here when a summary line is written
+  unit_cell = ' '.join(f'{v:6.2f}' if e > 1.0e-5 else f'{round(v,0):3.0f}' for (v, e) in zip(r['uc'], r['uc_sd']))
+  rmsds = ' '.join(f'{v:8.5f}' for v in r['rmsds'])
+  return f"{r['dataset_id']} {r['sg']} {unit_cell} {r['indexed']:5d} {r['unindexed']:5d} {100*r['indexed']/r['total']:5.1f} {rmsds}"
 
 def run(datasets_json):
   # start logging to stdout
@@ -209,9 +452,8 @@ def run(datasets_json):
   log.info(f'Start time: {str(time.asctime(time.localtime(time.time())))}')
   # read datasets.json:
   try:
-    with open(datasets_json) as f:
-      datasets = json.load(f)
-  except json.decoder.JSONDecodeError as e:
+    datasets = read_json(datasets_json)
+  except ValueError as e:
     sys.exit(f'Unable to read {datasets_json} Error {e}')
   
   for dataset in datasets['datasets']:
@@ -220,19 +462,52 @@ def run(datasets_json):
     else:
       log.info(f'Processing dataset {dataset["file"]} as {datasets["parameters"]["sample"]}/grid{dataset["grid"]}/xtal{dataset["xtal"]:03}')
   process_dataset = ProcessDataset(datasets['parameters'])
-  results = easy_mp.parallel_map(process_dataset,
-                                iterable=datasets['datasets'],
-                                processes = datasets['parameters']['njobs'],
-                                preserve_order=True
-                               )
+  # forked workers inherit the imported DIALS modules, spawned ones have to import them again
+  # fork is only safe on Linux, macOS and Windows use spawn
+  start_method = 'fork' if sys.platform.startswith('linux') else 'spawn'
+  if start_method == 'spawn':
+    log.info('Warning: worker processes are started with spawn and will each re-import DIALS')
+  mp_context = multiprocessing.get_context(start_method)
+  # batch datasets so that each worker task processes several of them
+  njobs = datasets['parameters']['njobs']
+  chunksize = max(1, len(datasets['datasets']) // (njobs * 4))
+  chunks = [datasets['datasets'][i:i + chunksize] for i in range(0, len(datasets['datasets']), chunksize)]
+  # only the lines needed for the final report are kept for each dataset
+  reports = [None] * len(datasets['datasets'])
+  def report(i, dataset_id, summary):
+    # exceptions raised in a done callback are not propagated so must be logged here
+    try:
+      r = summary.result()
+    except Exception as e:
+      log.info(f'{dataset_id} failed to read results Error {e}')
+      return
+    reports[i] = (r['output_files'], format_summary(r))
+  log_queue = mp_context.Queue()
+  ncores = available_cores()
+  budget = CoreBudget(datasets['parameters'].get('ncores') or ncores, mp_context)
+  listener = logging.handlers.QueueListener(log_queue, ch, fh)
+  listener.start()
+  # reading the integrated files releases the GIL so is done in threads while the workers carry on
+  with ThreadPoolExecutor(max_workers=ncores) as threads:
+    try:
+      with ProcessPoolExecutor(max_workers=njobs, mp_context=mp_context, initializer=init_worker, initargs=(log_queue, budget)) as executor:
+        futures = {executor.submit(process_dataset, chunk):i * chunksize for i, chunk in enumerate(chunks)}
+        n_finished = 0
+        for future in as_completed(futures):
+          chunk_results = future.result()
+          for i, r in enumerate(chunk_results, start=futures[future]):
+            if r is not None:
+              threads.submit(process_dataset.summarise, **r).add_done_callback(functools.partial(report, i, r['dataset_id']))
+          n_finished += len(chunk_results)
+          log.info(f'{n_finished} of {len(datasets["datasets"])} datasets finished')
+    finally:
+      listener.stop()
   log.info('Created the following integrated files:')
-  successful_results = [r for r in results if r is not None]
-  for r in successful_results:
-    if len(r['output_files']) > 0:
-      log.info(f"{r['output_files'][0]} {r['output_files'][1]}")
-  log.info('Summary of results:')
-  for r in successful_results:
-    log.info(f"{r['dataset_id']} {r['sg']} {' '.join(r['uc'])} {r['indexed']:5d} {r['unindexed']:5d} {100*r['indexed']/r['total']:5.1f} {r['rmsds']}")
+  successful_reports = [r for r in reports if r is not None]
+  for output_files, _ in successful_reports:
+    if len(output_files) > 0:
+      log.info(f"{output_files[0]} {output_files[1]}")
+  log.info('Summary of results:\n' + '\n'.join(summary for _, summary in successful_reports))
   log.info(f'End time: {str(time.asctime(time.localtime(time.time())))}')
 if __name__ == '__main__':
   if len(sys.argv) == 1: